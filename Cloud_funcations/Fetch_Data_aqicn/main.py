@@ -1,11 +1,15 @@
 import datetime
+import gzip
 import requests
-import json
+import orjson
 import os
 import time
 import logging
 from google.cloud import storage
-from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import flask
 from flask import Flask
@@ -20,62 +24,95 @@ logging.basicConfig(level=logging.INFO,
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 BUCKET_NAME = os.getenv("BUCKET_NAME", "fetch_aqicn")
+# Cities to search, comma-separated (e.g. CITIES="Bangkok,Chiang Mai");
+# falls back to the defaults when unset or when it names no cities
+DEFAULT_CITIES = ["Bangkok", "Chiang Mai", "Phuket", "Ayutthaya", "Chonburi"]
+THAI_CITIES = [city.strip() for city in os.getenv("CITIES", "").split(",") if city.strip()] or DEFAULT_CITIES
 
 # Environment-specific configurations
-MAX_WORKERS = int(os.getenv("MAX_WORKERS", "10"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "50"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "10"))
+MAX_ATTEMPTS = 3  # First try plus retries
+
+# Initialize clients once per instance; Cloud Run reuses them across requests.
+# Uses default credentials (set via GOOGLE_APPLICATION_CREDENTIALS or Cloud Run IAM)
+storage_client = storage.Client()
+
+# WAQI endpoints; the token and query go in params= rather than the URL string
+SEARCH_URL = "https://api.waqi.info/search/"
+FEED_URL = "https://api.waqi.info/feed/@{station_id}/"
+
+# Shared HTTP session: keeps connections to api.waqi.info alive across calls
+# and retries transient failures, instead of a new TCP+TLS handshake per request.
+# pool_block caps in-flight requests at MAX_WORKERS across overlapping runs;
+# extra feed threads wait for a free connection rather than opening more
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    pool_block=True,
+    max_retries=Retry(total=MAX_ATTEMPTS - 1, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])
+))
+# Ask for compressed JSON over persistent connections
+SESSION.headers.update({
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+    "User-Agent": "aqicn-fetch/1.0",
+})
 
 def fetch_city_stations(city):
     """Fetch stations for a specific city with retry logic."""
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            search_url = f"https://api.waqi.info/search/?token={TOKEN}&keyword={city}"
-            response = requests.get(search_url, timeout=REQUEST_TIMEOUT)
-            response.raise_for_status()
-            data = response.json()
-            stations = data.get("data", [])
-            logging.info(f"Found {len(stations)} stations in {city}")
-            
-            # Ensure stations are dictionaries and add metadata
-            valid_stations = []
-            for station in stations:
-                if isinstance(station, dict):
-                    station["source_city"] = city  # Add city metadata
-                    valid_stations.append(station)
-                else:
-                    logging.warning(f"Invalid station format for {city}: {station}")
-            return valid_stations
-        except requests.RequestException as e:
-            logging.warning(f"Attempt {attempt+1}/{max_retries} failed for {city}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2)
+    try:
+        response = SESSION.get(SEARCH_URL, params={"token": TOKEN, "keyword": city}, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        stations = data.get("data", [])
+        logging.info("Found %d stations in %s", len(stations), city)
+        
+        # Ensure stations are dictionaries and add metadata
+        valid_stations = []
+        for station in stations:
+            if isinstance(station, dict):
+                station["source_city"] = city  # Add city metadata
+                valid_stations.append(station)
             else:
-                logging.error(f"Failed to fetch stations for {city} after {max_retries} attempts")
-                return []
+                logging.warning("Invalid station format for %s: %s", city, station)
+        return valid_stations
+    except requests.exceptions.RetryError as e:
+        logging.error("Failed to fetch stations for %s after %d attempts: %s", city, MAX_ATTEMPTS, e)
+        return []
+    except requests.RequestException as e:
+        logging.error("Failed to fetch stations for %s: %s", city, e)
+        return []
 
-def fetch_station_data(station):
+def fetch_station_data(station, fetched_at):
     """Fetch data for a single station with error handling."""
     try:
         station_id = station.get("uid")
         if not station_id:
-            logging.warning(f"Skipping station with no UID: {station}")
+            logging.warning("Skipping station with no UID: %s", station)
             return None
         
-        feed_url = f"https://api.waqi.info/feed/@{station_id}/?token={TOKEN}"
-        response = requests.get(feed_url, timeout=REQUEST_TIMEOUT)
+        feed_url = FEED_URL.format(station_id=station_id)
+        response = SESSION.get(feed_url, params={"token": TOKEN}, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        data = response.json().get("data", {})
+        payload = orjson.loads(response.content)
+        if payload.get("status") != "ok":
+            # Error responses carry a message string in "data", not a station object
+            logging.warning("Skipping station %s: API status %s: %s", station_id, payload.get("status"), payload.get("data"))
+            return None
+        data = payload.get("data", {})
         
         if data:
             data["meta"] = {
                 "city": station.get("source_city", "Unknown"),
                 "station_id": station_id,
-                "timestamp": datetime.datetime.now().isoformat()
+                "timestamp": fetched_at
             }
         return data
     except Exception as e:
-        logging.error(f"Error processing station {station.get('uid', 'unknown')}: {e}")
+        logging.error("Error processing station %s: %s", station.get("uid", "unknown"), e)
         return None
 
 def upload_to_gcs(data, bucket_name=BUCKET_NAME):
@@ -84,25 +121,25 @@ def upload_to_gcs(data, bucket_name=BUCKET_NAME):
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         blob_name = f"thailand_air_quality_{timestamp}.json"
         
-        # Use default credentials (set via GOOGLE_APPLICATION_CREDENTIALS or Cloud Run IAM)
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        if not bucket.exists():
+        # orjson emits compact UTF-8 bytes directly: the blob is only read by the processor.
+        # Stored gzip-encoded (~8x smaller); GCS clients decompress it transparently on download
+        payload = gzip.compress(orjson.dumps(data), compresslevel=6)
+        blob = storage_client.bucket(bucket_name).blob(blob_name)
+        blob.content_encoding = "gzip"
+        try:
+            blob.upload_from_string(payload, content_type='application/json')
+        except NotFound:
+            # Only pay for bucket creation when the upload shows it is missing
             logging.info(f"Bucket {bucket_name} does not exist, creating it")
-            client.create_bucket(bucket_name, location="us-central1")
-        
-        blob = bucket.blob(blob_name)
-        blob.upload_from_string(
-            json.dumps(data, indent=2),
-            content_type='application/json'
-        )
+            storage_client.create_bucket(bucket_name, location="us-central1")
+            blob.upload_from_string(payload, content_type='application/json')
         logging.info(f"Data uploaded to gs://{bucket_name}/{blob_name}")
         return f"gs://{bucket_name}/{blob_name}"
     except Exception as e:
         logging.error(f"Failed to upload to GCS: {e}")
         local_file = f"/tmp/thailand_air_quality_{timestamp}.json"
-        with open(local_file, "w") as f:
-            json.dump(data, f, indent=2)
+        with open(local_file, "wb") as f:
+            f.write(orjson.dumps(data))
         logging.info(f"Saved to local file as fallback: {local_file}")
         return local_file
 
@@ -116,38 +153,30 @@ def main():
         logging.error(error_msg)
         return flask.jsonify({"success": False, "error": error_msg}), 500
     
-    thai_cities = [
-        "Bangkok", "Chiang Mai", "Phuket", "Ayutthaya", "Chonburi"
-    ]
-    
-    # Fetch stations in parallel
-    city_stations = {}
-    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(thai_cities))) as executor:
-        future_to_city = {executor.submit(fetch_city_stations, city): city for city in thai_cities}
+    # Fetch stations in parallel, keeping the first occurrence of each station
+    unique_stations = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(THAI_CITIES))) as executor:
+        future_to_city = {executor.submit(fetch_city_stations, city): city for city in THAI_CITIES}
         for future in future_to_city:
             city = future_to_city[future]
             try:
-                stations = future.result()
-                if stations:
-                    city_stations[city] = stations
+                for station in future.result():
+                    station_id = station.get("uid")
+                    if station_id:
+                        unique_stations.setdefault(station_id, station)
             except Exception as e:
-                logging.error(f"Error fetching stations for {city}: {e}")
-    
-    # Collect unique stations
-    unique_stations = {}
-    for city, stations in city_stations.items():
-        for station in stations:
-            station_id = station.get("uid")
-            if station_id and station_id not in unique_stations:
-                unique_stations[station_id] = station
+                logging.error("Error fetching stations for %s: %s", city, e)
     
     logging.info(f"Processing {len(unique_stations)} unique stations")
     
-    # Fetch station data in parallel
+    # Fetch station data in parallel; feeds only wait on the network,
+    # so use one thread per station up to the HTTP pool size (MAX_WORKERS)
     results = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(fetch_station_data, station) for station in unique_stations.values()]
-        for future in futures:
+    fetched_at = datetime.datetime.now().isoformat()  # One timestamp for the whole run
+    workers = max(1, min(MAX_WORKERS, len(unique_stations)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_station_data, station, fetched_at) for station in unique_stations.values()]
+        for future in as_completed(futures):
             result = future.result()
             if result:
                 results.append(result)
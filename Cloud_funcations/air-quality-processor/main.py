@@ -1,6 +1,8 @@
 import functions_framework
 import base64
-import json
+import collections
+import io
+import orjson
 import os
 from google.cloud import storage
 from google.cloud import bigquery
@@ -14,75 +16,127 @@ BUCKET_NAME = os.getenv("BUCKET_NAME", "fetch_aqicn")
 PROJECT_ID = os.getenv("PROJECT_ID", "propane-net-455409-s5")
 DATASET_ID = "air_quality"
 TABLE_ID = "raw_data"
+# Malformed rows a load job may skip before failing the whole batch
+MAX_BAD_RECORDS = int(os.getenv("MAX_BAD_RECORDS", "10"))
+# Station idx values logged per skip reason
+SKIP_SAMPLE_LIMIT = 5
 
-# Initialize clients
+# Initialize clients and references once per instance
 storage_client = storage.Client()
 bq_client = bigquery.Client()
+bucket = storage_client.bucket(BUCKET_NAME)
+table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID)
+
+# Batch load jobs append newline-delimited JSON using the table's existing schema
+LOAD_JOB_CONFIG = bigquery.LoadJobConfig(
+    source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    ignore_unknown_values=True,
+    max_bad_records=MAX_BAD_RECORDS,
+)
 
 def process_json_data(file_path):
     """Process JSON data from GCS and prepare for BigQuery."""
-    bucket = storage_client.bucket(BUCKET_NAME)
     blob = bucket.blob(file_path)
     try:
-        json_data = json.loads(blob.download_as_string())
+        json_data = orjson.loads(blob.download_as_bytes())
     except Exception as e:
         logging.error(f"Failed to parse JSON file {file_path}: {e}")
         return []
+    return build_rows(json_data)
+
+def record_skip(skip_counts, skip_samples, reason, idx):
+    """Count a skipped station, keeping its idx only while the reason has few samples."""
+    skip_counts[reason] += 1
+    samples = skip_samples[reason]
+    if len(samples) < SKIP_SAMPLE_LIMIT:
+        samples.append(idx)
+
+def build_row(city, station, skip_counts, skip_samples):
+    """Build a BigQuery row for one station, or record why it is invalid and return None."""
+    idx = station.get("idx")
+    try:
+        # Validate aqi: feeds encode it as a JSON number, or "-" when unavailable
+        aqi = station.get("aqi")
+        if not isinstance(aqi, int):
+            record_skip(skip_counts, skip_samples, "invalid aqi", idx)
+            return None
+
+        # Validate timestamp
+        timestamp = (station.get("time") or {}).get("iso")
+        if not timestamp:
+            record_skip(skip_counts, skip_samples, "empty or missing timestamp", idx)
+            return None
+
+        # Build row for BigQuery, resolving each nested object once
+        iaqi = station.get("iaqi") or {}
+        geo = (station.get("city") or {}).get("geo") or (None, None)
+        meta = station.get("meta") or {}
+        return {
+            "station_id": idx,
+            "city": meta.get("city", "Unknown"),
+            "timestamp": timestamp,
+            "aqi": aqi,
+            "pm25": (iaqi.get("pm25") or {}).get("v"),
+            "pm10": (iaqi.get("pm10") or {}).get("v"),
+            "temperature": (iaqi.get("t") or {}).get("v"),
+            "humidity": (iaqi.get("h") or {}).get("v"),
+            "latitude": geo[0],
+            "longitude": geo[1]
+        }
+    except Exception as e:
+        logging.error("Error processing station %s in %s: %s", idx, city, e)
+        return None
 
-    rows_to_insert = []
+def build_rows(json_data):
+    """Lazily validate stations in a {city: [station, ...]} batch and yield BigQuery rows."""
+    seen = set()  # The same station can appear under several cities
+    skip_counts = collections.Counter()  # Reason -> number of skipped stations
+    skip_samples = collections.defaultdict(list)  # Reason -> first few skipped idx values
     for city, stations in json_data.items():
         for station in stations:
-            try:
-                # Validate aqi
-                aqi = station.get("aqi")
-                if aqi == "-" or aqi is None:
-                    logging.warning(f"Skipping station {station.get('idx', 'unknown')} in {city}: Invalid aqi value: {aqi}")
-                    continue
-                try:
-                    aqi = int(aqi)  # Ensure aqi is an integer
-                except (ValueError, TypeError):
-                    logging.warning(f"Skipping station {station.get('idx', 'unknown')} in {city}: Cannot convert aqi to integer: {aqi}")
-                    continue
-
-                # Validate timestamp
-                timestamp = station.get("time", {}).get("iso")
-                if not timestamp:
-                    logging.warning(f"Skipping station {station.get('idx', 'unknown')} in {city}: Empty or missing timestamp")
+            idx = station.get("idx")
+            if idx is not None:
+                if idx in seen:
                     continue
+                seen.add(idx)
+            row = build_row(city, station, skip_counts, skip_samples)
+            if row is not None:
+                yield row
 
-                # Build row for BigQuery
-                row = {
-                    "station_id": station.get("idx"),
-                    "city": station.get("meta", {}).get("city", "Unknown"),
-                    "timestamp": timestamp,
-                    "aqi": aqi,
-                    "pm25": station.get("iaqi", {}).get("pm25", {}).get("v", None),
-                    "pm10": station.get("iaqi", {}).get("pm10", {}).get("v", None),
-                    "temperature": station.get("iaqi", {}).get("t", {}).get("v", None),
-                    "humidity": station.get("iaqi", {}).get("h", {}).get("v", None),
-                    "latitude": station.get("city", {}).get("geo", [None, None])[0],
-                    "longitude": station.get("city", {}).get("geo", [None, None])[1]
-                }
-                rows_to_insert.append(row)
-            except Exception as e:
-                logging.error(f"Error processing station {station.get('idx', 'unknown')} in {city}: {e}")
-                continue
-    return rows_to_insert
+    # One summary per reason instead of a warning per skipped station
+    for reason, count in skip_counts.items():
+        logging.warning("Skipped %d stations with %s (samples: %s)", count, reason, skip_samples[reason])
 
 def append_to_bigquery(rows):
-    """Append processed rows to BigQuery without retries."""
-    if not rows:
+    """Append processed rows to BigQuery in a single load job, without retries."""
+    # Serialize rows as they are produced so no intermediate row list is kept
+    payload = io.BytesIO()
+    row_count = 0
+    for row in rows:
+        payload.write(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+        row_count += 1
+    if not row_count:
         logging.info("No valid rows to insert into BigQuery")
         return True  # Success if no rows to insert
 
-    table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID)
-    errors = bq_client.insert_rows_json(table_ref, rows)
-    if errors:
-        logging.error(f"Errors inserting rows: {errors}")
-        raise Exception(f"Failed to insert rows into BigQuery: {errors}")
-    else:
-        logging.info(f"Successfully appended {len(rows)} rows to BigQuery")
-        return True
+    # A known size lets the client send a single multipart upload instead of a resumable session
+    size = payload.tell()
+    load_job = bq_client.load_table_from_file(payload, table_ref, size=size, rewind=True, job_config=LOAD_JOB_CONFIG)
+    try:
+        load_job.result()  # Wait for the job; raises if it failed
+    except Exception as e:
+        logging.error(f"Errors loading rows in job {load_job.job_id}: {load_job.errors}")
+        raise Exception(f"Failed to load rows into BigQuery: {e}")
+    if load_job.errors:
+        logging.warning(f"Load job {load_job.job_id} skipped bad rows: {load_job.errors}")
+    # Report what BigQuery wrote, so a short load is visible next to what was sent
+    logging.info(f"Successfully appended {load_job.output_rows} of {row_count} rows to BigQuery (job {load_job.job_id})")
+    return True
+
+def process_records(data_by_city):
+    """Append an in-memory {city: [station, ...]} batch to BigQuery without a GCS round trip."""
+    return append_to_bigquery(build_rows(data_by_city))
 
 @functions_framework.cloud_event
 def process_gcs_file(cloud_event):
@@ -4,9 +4,16 @@ import json
 import os
 import time
 import logging
-from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
+try:
+    import orjson  # Faster JSON encode/decode when available
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,32 +21,53 @@ logging.basicConfig(level=logging.INFO,
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
+# Cities to search, comma-separated (e.g. CITIES="Bangkok,Chiang Mai");
+# falls back to the defaults when unset or when it names no cities
+DEFAULT_CITIES = ["Bangkok", "Chiang Mai", "Phuket", "Ayutthaya", "Chonburi"]
+THAI_CITIES = [city.strip() for city in os.getenv("CITIES", "").split(",") if city.strip()] or DEFAULT_CITIES
+MAX_WORKERS = 50
+MAX_ATTEMPTS = 3  # First try plus retries
+
+# WAQI endpoints; the token and query go in params= rather than the URL string
+SEARCH_URL = "https://api.waqi.info/search/"
+FEED_URL = "https://api.waqi.info/feed/@{station_id}/"
+
+# Reuse connections to api.waqi.info and retry transient failures
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=MAX_ATTEMPTS - 1, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])
+))
+# Ask for compressed JSON over persistent connections
+SESSION.headers.update({
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+    "User-Agent": "aqicn-fetch/1.0",
+})
 
 def fetch_city_stations(city):
     """Fetch stations for a specific city with retry logic"""
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            search_url = f"https://api.waqi.info/search/?token={TOKEN}&keyword={city}"
-            response = requests.get(search_url, timeout=10)
-            response.raise_for_status()  # Raise exception for HTTP errors
-            stations = response.json().get("data", [])
-            logging.info(f"Found {len(stations)} stations in {city}")
+    try:
+        response = SESSION.get(SEARCH_URL, params={"token": TOKEN, "keyword": city}, timeout=10)
+        response.raise_for_status()  # Raise exception for HTTP errors
+        stations = response.json().get("data", [])
+        logging.info("Found %d stations in %s", len(stations), city)
+        
+        # Add city metadata to each station
+        for station in stations:
+            station['source_city'] = city
             
-            # Add city metadata to each station
-            for station in stations:
-                station['source_city'] = city
-                
-            return stations
-        except requests.exceptions.RequestException as e:
-            logging.warning(f"Attempt {attempt+1}/{max_retries} failed for {city}: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(2)  # Wait before retrying
-            else:
-                logging.error(f"Failed to fetch stations for {city} after {max_retries} attempts")
-                return []
+        return stations
+    except requests.exceptions.RetryError as e:
+        logging.error("Failed to fetch stations for %s after %d attempts: %s", city, MAX_ATTEMPTS, e)
+        return []
+    except requests.exceptions.RequestException as e:
+        logging.error("Failed to fetch stations for %s: %s", city, e)
+        return []
 
-def fetch_station_data(station):
+def fetch_station_data(station, fetched_at):
     """Fetch data for a single station with error handling"""
     try:
         # Extract station ID
@@ -49,27 +77,41 @@ def fetch_station_data(station):
         elif isinstance(station, dict) and "station" in station and "uid" in station.get("station", {}):
             station_id = int(station["station"]["uid"])
         else:
-            logging.warning(f"Skipping station with unknown structure")
+            logging.warning("Skipping station with unknown structure")
             return None
             
         # Get station data
-        feed_url = f"https://api.waqi.info/feed/@{station_id}/?token={TOKEN}"
-        response = requests.get(feed_url, timeout=10)
+        feed_url = FEED_URL.format(station_id=station_id)
+        response = SESSION.get(feed_url, params={"token": TOKEN}, timeout=10)
         response.raise_for_status()
-        data = response.json().get("data", {})
+        payload = orjson.loads(response.content) if orjson else response.json()
+        if payload.get("status") != "ok":
+            # Error responses carry a message string in "data", not a station object
+            logging.warning("Skipping station %s: API status %s: %s", station_id, payload.get("status"), payload.get("data"))
+            return None
+        data = payload.get("data", {})
         
         # Add metadata
         if data:
             data["meta"] = {
                 "city": station.get("source_city", "Unknown"),
                 "station_id": station_id,
-                "timestamp": datetime.datetime.now().isoformat()
+                "timestamp": fetched_at
             }
         return data
     except Exception as e:
-        logging.error(f"Error processing station {station.get('uid', 'unknown')}: {str(e)}")
+        logging.error("Error processing station %s: %s", station.get("uid", "unknown"), e)
         return None
 
+def write_json(path, data):
+    """Write data to path as compact JSON, using orjson if it is installed"""
+    if orjson:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(path, "w") as f:
+            json.dump(data, f, separators=(',', ':'))
+
 def save_data_locally(data):
     """Save data to local files"""
     # Create a data directory if it doesn't exist
@@ -81,26 +123,24 @@ def save_data_locally(data):
     filename = f"{output_dir}/thailand_air_quality_{timestamp}.json"
     
     # Save main data file
-    with open(filename, "w") as f:
-        json.dump(data, f, indent=2)
+    write_json(filename, data)
     logging.info(f"Data saved to {filename}")
     
     # Save individual city files
     for city, city_data in data.items():
         city_filename = f"{output_dir}/{city}_air_quality_{timestamp}.json"
-        with open(city_filename, "w") as f:
-            json.dump(city_data, f, indent=2)
-        logging.info(f"{city} data saved to {city_filename}")
+        write_json(city_filename, city_data)
+        logging.info("%s data saved to %s", city, city_filename)
     
     # Save summary file
+    station_counts = {city: len(stations) for city, stations in data.items()}
     summary_filename = f"{output_dir}/summary_{timestamp}.json"
-    with open(summary_filename, "w") as f:
-        json.dump({
-            "timestamp": datetime.datetime.now().isoformat(),
-            "cities": list(data.keys()),
-            "station_counts": {city: len(stations) for city, stations in data.items()},
-            "total_stations": sum(len(stations) for stations in data.values())
-        }, f, indent=2)
+    write_json(summary_filename, {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "cities": list(station_counts),
+        "station_counts": station_counts,
+        "total_stations": sum(station_counts.values())
+    })
     
     return filename
 
@@ -108,54 +148,41 @@ def main():
     """Main function for local testing"""
     start_time = time.time()
     
-    # List of major cities in Thailand
-    thai_cities = [
-        "Bangkok", "Chiang Mai", "Phuket", "Ayutthaya", "Chonburi"
-    ]
-    
     if not TOKEN:
         logging.error("API TOKEN is missing! Please set it in your .env file.")
         return
     
-    # Fetch stations for each city in parallel
-    city_stations = {}
-    with ThreadPoolExecutor(max_workers=min(5, len(thai_cities))) as executor:
-        future_to_city = {executor.submit(fetch_city_stations, city): city for city in thai_cities}
+    # Fetch stations for each city in parallel, removing duplicates as they arrive
+    unique_stations = {}
+    with ThreadPoolExecutor(max_workers=min(5, len(THAI_CITIES))) as executor:
+        future_to_city = {executor.submit(fetch_city_stations, city): city for city in THAI_CITIES}
         for future in future_to_city:
             city = future_to_city[future]
             try:
-                stations = future.result()
-                if stations:
-                    city_stations[city] = stations
+                for station in future.result():
+                    station_id = station.get("uid") or station.get("station", {}).get("uid")
+                    if station_id:
+                        unique_stations.setdefault(station_id, station)
             except Exception as e:
-                logging.error(f"Error fetching stations for {city}: {str(e)}")
-    
-    # Process all unique stations
-    all_stations = []
-    for stations in city_stations.values():
-        all_stations.extend(stations)
-    
-    # Remove duplicates
-    unique_stations = {}
-    for station in all_stations:
-        station_id = station.get("uid") or station.get("station", {}).get("uid")
-        if station_id and station_id not in unique_stations:
-            unique_stations[station_id] = station
+                logging.error("Error fetching stations for %s: %s", city, e)
     
     logging.info(f"Processing {len(unique_stations)} unique stations")
     
-    # Fetch data for all stations with parallelism
+    # Fetch data for all stations with parallelism; feeds only wait on the network,
+    # so use one thread per station up to the HTTP pool size (MAX_WORKERS)
     results = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(fetch_station_data, station) 
+    fetched_at = datetime.datetime.now().isoformat()  # One timestamp for the whole run
+    workers = max(1, min(MAX_WORKERS, len(unique_stations)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_station_data, station, fetched_at) 
                   for station in unique_stations.values()]
-        for future in futures:
+        for future in as_completed(futures):
             try:
                 data = future.result()
                 if data:
                     results.append(data)
             except Exception as e:
-                logging.error(f"Error in station data processing: {str(e)}")
+                logging.error("Error in station data processing: %s", e)
     
     # Group data by city
     data_by_city = {}